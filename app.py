@@ -1,269 +1,208 @@
+import atexit
+import base64
+import hashlib
+import hmac
+import logging
 import os
-import time
-import requests
-from flask import Flask, request, jsonify
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+from cachetools import TTLCache
+from flask import Flask, request
+
+from shopify_client import (
+    REDIS,
+    ShopifyGraphQLError,
+    get_market_price_lists,
+    get_variant_product_and_inventory_by_sku,
+    invalidate_sku,
+    invalidate_price_lists,
+    update_price_lists_bulk,
+    get_primary_location_id,
+    set_inventory_absolute,
+    variant_update_input,
+    update_product_title,
+    set_metafield,
+)
 
 app = Flask(__name__)
 
-print("🚀 Flask app starting...", flush=True)
+# Request and worker threads only enqueue records; a single listener thread
+# does the stream writes, so nobody blocks on stdout/stderr.
+_LOG_QUEUE = queue.SimpleQueue()
+_LOG_LISTENER = QueueListener(_LOG_QUEUE, logging.StreamHandler())
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format=logging.BASIC_FORMAT,
+    handlers=[QueueHandler(_LOG_QUEUE)],
+)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+logger = logging.getLogger(__name__)
+
+logger.info("🚀 Flask app starting...")
 
 # ---------- ENV ----------
-SHOP = os.getenv("SHOPIFY_SHOP")
-CLIENT_ID = os.getenv("SHOPIFY_CLIENT_ID")
-CLIENT_SECRET = os.getenv("SHOPIFY_CLIENT_SECRET")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
-API_VERSION = os.getenv("SHOPIFY_API_VERSION", "2024-07")
+_EXPECTED_SECRET = (WEBHOOK_SECRET or "").encode()
 
-# ---------- TOKEN CACHE ----------
-SHOPIFY_TOKEN = None
-TOKEN_TIME = 0
-
-def get_shopify_access_token():
-    global SHOPIFY_TOKEN, TOKEN_TIME
-
-    if SHOPIFY_TOKEN and time.time() - TOKEN_TIME < 3000:
-        print("🔁 Using cached Shopify token", flush=True)
-        return SHOPIFY_TOKEN
-
-    print("🔐 Requesting Shopify access token...", flush=True)
-
-    url = f"https://{SHOP}/admin/oauth/access_token"
-
-    payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type": "client_credentials"
-    }
-
-    res = requests.post(url, json=payload)
-    print("🔁 Token raw response:", res.text, flush=True)
-
-    data = res.json()
-    if not data.get("access_token"):
-        raise Exception("❌ Token failed")
-
-    SHOPIFY_TOKEN = data["access_token"]
-    TOKEN_TIME = time.time()
-
-    print("✅ Token received", flush=True)
-    return SHOPIFY_TOKEN
+# Comma-separated market codes whose price lists are synced, and whether the
+# custom.size product metafield is written.
+ENABLE_MARKETS = {
+    m.strip() for m in os.getenv("ENABLE_MARKETS", "UAE,Asia,America").split(",") if m.strip()
+}
+ENABLE_METAFIELDS = os.getenv("ENABLE_METAFIELDS", "1") == "1"
 
 # ---------- HELPERS ----------
-def _json_headers():
-    return {
-        "X-Shopify-Access-Token": get_shopify_access_token(),
-        "Content-Type": "application/json",
-    }
-
-def _graphql_url():
-    return f"https://{SHOP}/admin/api/{API_VERSION}/graphql.json"
+def _json_response(obj, status=200):
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
 
-def _rest_url(path):
-    return f"https://{SHOP}/admin/api/{API_VERSION}/{path}"
-
-def _to_number(x):
+def _request_json():
+    # None when the body is not a JSON object.
     try:
-        return float(x) if x not in (None, "") else None
-    except:
+        data = orjson.loads(request.get_data(cache=True) or b"{}")
+    except orjson.JSONDecodeError:
         return None
 
-# ---------- MARKET ----------
-MARKET_NAMES = {
-    "UAE": "United Arab Emirates",
-    "Asia": "Asia Market with 55 rate",
-    "America": "America catlog",
-}
-
-# ---------- GRAPHQL ----------
-def shopify_graphql(query, variables=None):
-    resp = requests.post(
-        _graphql_url(),
-        headers=_json_headers(),
-        json={"query": query, "variables": variables},
-    )
-    resp.raise_for_status()
-    return resp.json()
-
-# ---------- PRICE LIST CACHE ----------
-CACHED_PRICE_LISTS = None
-
-def get_market_price_lists():
-    global CACHED_PRICE_LISTS
-
-    if CACHED_PRICE_LISTS:
-        return CACHED_PRICE_LISTS
-
-    QUERY = """
-    query {
-      catalogs(first: 20, type: MARKET) {
-        nodes {
-          title
-          status
-          priceList { id currency }
-        }
-      }
-    }
-    """
-
-    res = shopify_graphql(QUERY)
-    price_lists = {}
-
-    for c in res.get("data", {}).get("catalogs", {}).get("nodes", []):
-        if c.get("status") == "ACTIVE" and c.get("priceList"):
-            price_lists[c["title"]] = {
-                "id": c["priceList"]["id"],
-                "currency": c["priceList"]["currency"],
-            }
-
-    print("📊 Price lists:", price_lists, flush=True)
-    CACHED_PRICE_LISTS = price_lists
-    return price_lists
-
-# ---------- VARIANT ----------
-def get_variant_product_and_inventory_by_sku(sku):
-    QUERY = """
-    query ($q: String!) {
-      productVariants(first: 1, query: $q) {
-        nodes { id product { id } }
-      }
-    }
-    """
+    if data is None:
+        return {}
+    return data if isinstance(data, dict) else None
 
-    res = shopify_graphql(QUERY, {"q": f"sku:{sku}"})
-    nodes = res.get("data", {}).get("productVariants", {}).get("nodes", [])
+def _authorized():
+    # Never accept anything when the secret is not configured.
+    if not _EXPECTED_SECRET:
+        return False
 
-    if not nodes:
-        return None, None, None, None
+    # Shopify-style senders sign the raw body; Airtable sends the shared secret.
+    sig = request.headers.get("X-Shopify-Hmac-Sha256")
+    if sig:
+        digest = hmac.new(_EXPECTED_SECRET, request.get_data(cache=True), hashlib.sha256).digest()
+        return hmac.compare_digest(sig.strip().encode(), base64.b64encode(digest))
 
-    variant_gid = nodes[0]["id"]
-    product_gid = nodes[0]["product"]["id"]
-    variant_id = variant_gid.split("/")[-1]
+    provided = (request.headers.get("X-Secret-Token") or "").strip().encode()
+    return hmac.compare_digest(provided, _EXPECTED_SECRET)
 
-    r = requests.get(_rest_url(f"variants/{variant_id}.json"), headers=_json_headers())
-    r.raise_for_status()
-
-    inventory_item_id = r.json()["variant"]["inventory_item_id"]
-
-    return variant_gid, product_gid, variant_id, inventory_item_id
-
-# ---------- PRICE ----------
-def update_variant_default_price(variant_id, price, compare_price=None):
-    payload = {"variant": {"id": int(variant_id), "price": str(price)}}
-
-    if compare_price is not None:
-        payload["variant"]["compare_at_price"] = str(compare_price)
-
-    print("💲 Updating default price →", payload, flush=True)
-
-    requests.put(
-        _rest_url(f"variants/{variant_id}.json"),
-        headers=_json_headers(),
-        json=payload,
-    ).raise_for_status()
-
-def update_price_list(price_list_id, variant_gid, price, currency, compare_price=None):
-    price_input = {
-        "variantId": variant_gid,
-        "price": {"amount": str(price), "currencyCode": currency},
-    }
-
-    if compare_price is not None:
-        price_input["compareAtPrice"] = {
-            "amount": str(compare_price),
-            "currencyCode": currency,
-        }
-
-    MUTATION = """
-    mutation ($pl: ID!, $prices: [PriceListPriceInput!]!) {
-      priceListFixedPricesAdd(priceListId: $pl, prices: $prices) {
-        userErrors { message }
-      }
-    }
-    """
-
-    shopify_graphql(MUTATION, {"pl": price_list_id, "prices": [price_input]})
-
-# ---------- INVENTORY ----------
-def get_primary_location_id():
-    r = requests.get(_rest_url("locations.json"), headers=_json_headers())
-    r.raise_for_status()
-    return r.json()["locations"][0]["id"]
-
-def set_inventory_absolute(inventory_item_id, location_id, quantity):
-    print("📦 Updating inventory:", quantity, flush=True)
-    requests.post(
-        _rest_url("inventory_levels/set.json"),
-        headers=_json_headers(),
-        json={
-            "inventory_item_id": int(inventory_item_id),
-            "location_id": int(location_id),
-            "available": int(quantity),
-        },
-    ).raise_for_status()
-
-# ---------- TITLE / BARCODE ----------
-def update_variant_details(variant_gid, title=None, barcode=None):
-    if not (title or barcode):
-        return
-
-    var_num = variant_gid.split("/")[-1]
-    url = _rest_url(f"variants/{var_num}.json")
-
-    payload = {"variant": {"id": int(var_num)}}
-    if title:
-        payload["variant"]["title"] = title
-    if barcode:
-        payload["variant"]["barcode"] = barcode
-
-    print("✏ Updating variant details:", payload, flush=True)
-    requests.put(url, headers=_json_headers(), json=payload).raise_for_status()
-
-def update_product_title(product_gid, title):
-    pid = product_gid.split("/")[-1]
-    url = _rest_url(f"products/{pid}.json")
-
-    payload = {"product": {"id": int(pid), "title": title}}
+def _to_number(x):
+    # Airtable usually sends JSON numbers, so skip the try/except for those.
+    # Exact type checks: a float is returned as-is without a new object.
+    if type(x) is float:
+        return x
+    if type(x) is int:
+        return float(x)
+    if x is None or x == "":
+        return None
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
 
-    print("✏ Updating product title:", payload, flush=True)
-    requests.put(url, headers=_json_headers(), json=payload).raise_for_status()
+# Payload fields that can lead to a Shopify write. Comparison prices are
+# only sent alongside their price, so on their own they are not actionable.
+_TEXT_FIELDS = ("Title", "Barcode", "Size")
+_NUMBER_FIELDS = ("UAE price", "Asia Price", "America Price", "Qty given in shopify")
 
-# ---------- METAFIELD ----------
-def set_metafield(owner_id_gid, namespace, key, mtype, value):
-    MUT = """
-    mutation metafieldsSet($metafields: [MetafieldsSetInput!]!) {
-      metafieldsSet(metafields: $metafields) {
-        userErrors { message }
-      }
-    }
-    """
-
-    variables = {
-        "metafields": [{
-            "ownerId": owner_id_gid,
-            "namespace": namespace,
-            "key": key,
-            "type": mtype,
-            "value": str(value)
-        }]
-    }
+def _has_updates(data):
+    for f in _TEXT_FIELDS:
+        if f == "Size" and not ENABLE_METAFIELDS:
+            continue
+        v = data.get(f)
+        if v is not None and str(v).strip():
+            return True
+
+    return any(_to_number(data.get(f)) is not None for f in _NUMBER_FIELDS)
+
+# ---------- CONCURRENCY ----------
+# Independent Shopify updates for one webhook are fanned out on this pool so
+# the handler waits for the slowest call instead of the sum of all of them.
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("SYNC_WORKERS", "8")))
+
+# Whole webhook syncs run here after the request has been acknowledged. Kept
+# separate from EXECUTOR so queued jobs can never starve their own fan-out.
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("JOB_WORKERS", "8")))
+
+# Upper bound on how long one record's fan-out may hold a job worker.
+SYNC_TIMEOUT = float(os.getenv("SYNC_TIMEOUT", "30"))
+
+# With REDIS_URL set, syncs go to a durable RQ queue (run `rq worker
+# shopify-sync`, see Procfile) so they survive restarts and failed jobs are
+# retried; otherwise they run in-process on JOB_EXECUTOR. The worker must not
+# fork per job (SimpleWorker), or every job re-imports this module and starts
+# with cold token/location/SKU caches, and its queued log records die with the
+# horse's os._exit. Per-SKU coalescing only applies to the in-process path.
+if REDIS is not None:
+    from rq import Queue, Retry
+
+    SYNC_QUEUE = Queue("shopify-sync", connection=REDIS)
+    SYNC_RETRY = Retry(max=3, interval=[10, 30, 60])
+else:
+    SYNC_QUEUE = None
+
+# ---------- IDEMPOTENCY ----------
+# Retried deliveries of the same webhook are dropped before any Shopify work.
+# Shared through Redis when available so every worker sees the same keys.
+IDEMPOTENCY_TTL = 600
+_SEEN = TTLCache(maxsize=50000, ttl=IDEMPOTENCY_TTL)
+_SEEN_LOCK = threading.Lock()
+
+def _idempotency_key(data):
+    key = request.headers.get("X-Idempotency-Key")
+    if not key and data.get("record_id") and data.get("last_modified"):
+        key = f"{data['record_id']}:{data['last_modified']}"
+    return key
+
+def _first_delivery(key, sku):
+    if REDIS is not None:
+        try:
+            return bool(REDIS.set(f"idem:{key}:{sku}", 1, nx=True, ex=IDEMPOTENCY_TTL))
+        except Exception as e:
+            # Fall back to this process's keys rather than failing the webhook.
+            logger.warning("⚠ Redis idempotency check failed: %r", e)
+
+    with _SEEN_LOCK:
+        if (key, sku) in _SEEN:
+            return False
+        _SEEN[(key, sku)] = True
+        return True
+
+def _release_delivery(key, sku):
+    # Undo _first_delivery when the sync could not be queued, so the sender's
+    # retry is processed instead of being dropped as a duplicate.
+    with _SEEN_LOCK:
+        _SEEN.pop((key, sku), None)
+
+    if REDIS is not None:
+        try:
+            REDIS.delete(f"idem:{key}:{sku}")
+        except Exception as e:
+            logger.warning("⚠ Redis idempotency release failed: %r", e)
+
+# ---------- SYNC TASKS ----------
+def sync_inventory(inventory_item_id, qty):
+    if qty is None:
+        return None
 
-    print("🧩 Setting metafield:", namespace, key, value, flush=True)
-    shopify_graphql(MUT, variables)
+    loc = get_primary_location_id()
+    set_inventory_absolute(inventory_item_id, loc, int(qty))
 
-# ---------- ROUTES ----------
-@app.route("/", methods=["GET"])
-def home():
-    return "✅ Airtable → Shopify Sync is running", 200
+def sync_variant_and_prices(variant_gid, variant_input, prices, compare_prices):
+    # The default price (productVariantUpdate) and every market price list
+    # share one GraphQL request.
+    updates = []
 
-@app.route("/airtable-webhook", methods=["POST"])
-def airtable_webhook():
+    if any(p is not None for p in prices.values()):
+        for market, pl in get_market_price_lists().items():
+            price = prices.get(market)
+            if price is None or market not in ENABLE_MARKETS:
+                continue
 
-    if (request.headers.get("X-Secret-Token") or "").strip() != WEBHOOK_SECRET:
-        return jsonify({"error": "Unauthorized"}), 401
+            updates.append((pl["id"], variant_gid, price, pl["currency"], compare_prices.get(market)))
 
-    data = request.json or {}
-    print("📦 Payload:", data, flush=True)
+    update_price_lists_bulk(updates, variant_input=variant_input)
 
+def sync_record(data):
     sku = data.get("SKU")
     title = data.get("Title")
     barcode = data.get("Barcode")
@@ -283,56 +222,177 @@ def airtable_webhook():
 
     qty = _to_number(data.get("Qty given in shopify"))
 
-    if not sku:
-        return jsonify({"error": "SKU missing"}), 400
-
-    variant_gid, product_gid, variant_id, inventory_item_id = get_variant_product_and_inventory_by_sku(sku)
+    variant_gid, product_gid, inventory_item_id = get_variant_product_and_inventory_by_sku(sku)
 
     if not variant_gid:
-        return jsonify({"error": "Variant not found"}), 404
+        logger.warning("❌ Variant not found for SKU %s", sku)
+        return
 
-    # ---- TITLE / BARCODE ----
-    if title or barcode:
-        update_variant_details(variant_gid, title, barcode)
+    # ---- FAN OUT INDEPENDENT UPDATES ----
+    tasks = []
+
+    # ---- VARIANT (BARCODE / DEFAULT PRICE) + PRICE LISTS ----
+    uae_price = prices["UAE"]
+    variant_input = variant_update_input(
+        variant_gid,
+        barcode=barcode,
+        price=uae_price,
+        compare_at_price=compare_prices["UAE"] if uae_price is not None else None,
+    )
+
+    if variant_input or any(p is not None for p in prices.values()):
+        tasks.append(partial(sync_variant_and_prices, variant_gid, variant_input, prices, compare_prices))
 
     if title:
-        update_product_title(product_gid, title)
+        tasks.append(partial(update_product_title, product_gid, title))
 
     # ---- SIZE (PRODUCT METAFIELD) ----
-    if size_value is not None and str(size_value).strip():
-        set_metafield(
+    if ENABLE_METAFIELDS and size_value is not None and str(size_value).strip():
+        tasks.append(partial(
+            set_metafield,
             product_gid,        # ✅ PRODUCT metafield
             "custom",
             "size",
             "single_line_text_field",
             size_value
-        )
-
-    # ---- PRICE ----
-    if prices["UAE"] is not None:
-        update_variant_default_price(variant_id, prices["UAE"], compare_prices["UAE"])
+        ))
 
     # ---- INVENTORY ----
     if qty is not None:
-        loc = get_primary_location_id()
-        set_inventory_absolute(inventory_item_id, loc, qty)
+        tasks.append(partial(sync_inventory, inventory_item_id, qty))
+
+    futures = [EXECUTOR.submit(task) for task in tasks]
+    done, not_done = wait(futures, timeout=SYNC_TIMEOUT)
+
+    failed = bool(not_done)
+    if not_done:
+        logger.error("❌ %d update(s) for SKU %s still running after %ss", len(not_done), sku, SYNC_TIMEOUT)
+
+    for f in done:
+        try:
+            f.result()
+        except Exception as e:
+            logger.error("❌ Update failed for SKU %s: %r", sku, e)
+            failed = True
+            # The cached ids may point at a deleted/recreated variant; GraphQL
+            # reports that as userErrors on an HTTP 200.
+            if isinstance(e, ShopifyGraphQLError) or getattr(getattr(e, "response", None), "status_code", None) in (404, 422):
+                invalidate_sku(sku)
+
+    if failed:
+        raise RuntimeError(f"Sync incomplete for SKU {sku}")
+
+    logger.info("🎉 SYNC COMPLETE: %s", sku)
+
+def _do_sync(data):
+    # Runs on JOB_EXECUTOR after the webhook has already been answered, so
+    # nothing may escape: log and drop.
+    try:
+        sync_record(data)
+    except Exception:
+        logger.exception("❌ Sync failed for SKU %s", data.get("SKU"))
+
+# ---------- PER-SKU COALESCING ----------
+# Bursts (bulk edits, initial loads) often send several webhooks for the same
+# SKU. While a SKU is queued or syncing, newer payloads are merged into its
+# pending one, so N webhooks cost at most one extra sync, and syncs for one
+# SKU never run concurrently or out of order.
+_PENDING = {}
+_RUNNING = set()
+_PENDING_LOCK = threading.Lock()
+
+def _submit_sync(data):
+    sku = data["SKU"]
+
+    with _PENDING_LOCK:
+        if sku in _PENDING:
+            _PENDING[sku].update(data)
+            logger.debug("🔗 Coalesced webhook for SKU %s", sku)
+            return
+        _PENDING[sku] = dict(data)
+        if sku in _RUNNING:
+            return
+        _RUNNING.add(sku)
+
+    JOB_EXECUTOR.submit(_drain_sku, sku)
+
+def _drain_sku(sku):
+    while True:
+        with _PENDING_LOCK:
+            data = _PENDING.pop(sku, None)
+            if data is None:
+                _RUNNING.discard(sku)
+                return
+        _do_sync(data)
+
+# ---------- ROUTES ----------
+@app.route("/", methods=["GET"])
+def home():
+    return "✅ Airtable → Shopify Sync is running", 200
 
-    # ---- PRICE LISTS ----
-    price_lists = get_market_price_lists()
+@app.route("/airtable-webhook", methods=["POST"])
+def airtable_webhook():
 
-    for market, price in prices.items():
-        if price is None:
-            continue
+    if not _authorized():
+        return _json_response({"error": "Unauthorized"}, 401)
 
-        pl = price_lists.get(MARKET_NAMES.get(market))
-        if not pl:
-            continue
+    data = _request_json()
+    if data is None:
+        return _json_response({"error": "Invalid JSON"}, 400)
+    logger.debug("📦 Payload: %s", data)
+
+    if not data.get("SKU"):
+        return _json_response({"error": "SKU missing"}, 400)
+
+    # Airtable also fires for fields we do not sync; skip the SKU lookup.
+    if not _has_updates(data):
+        return _json_response({"status": "noop"}, 200)
+
+    idem_key = _idempotency_key(data)
+    if idem_key and not _first_delivery(idem_key, data["SKU"]):
+        logger.info("🔁 Duplicate delivery %s for SKU %s", idem_key, data["SKU"])
+        return _json_response({"status": "duplicate"}, 200)
+
+    try:
+        if SYNC_QUEUE is not None:
+            SYNC_QUEUE.enqueue(sync_record, data, retry=SYNC_RETRY)
+        else:
+            _submit_sync(data)
+    except Exception:
+        logger.exception("❌ Could not queue sync for SKU %s", data["SKU"])
+        if idem_key:
+            _release_delivery(idem_key, data["SKU"])
+        return _json_response({"error": "Sync not queued"}, 503)
+    return _json_response({"status": "queued"}, 202)
+
+@app.route("/invalidate-sku", methods=["POST"])
+def invalidate_sku_route():
+    if not _authorized():
+        return _json_response({"error": "Unauthorized"}, 401)
+
+    data = _request_json()
+    if data is None:
+        return _json_response({"error": "Invalid JSON"}, 400)
+
+    sku = data.get("SKU")
+    if not sku:
+        return _json_response({"error": "SKU missing"}, 400)
+
+    invalidate_sku(sku)
+    logger.info("🧹 Invalidated cached lookup for SKU %s", sku)
+    return _json_response({"status": "invalidated"}, 200)
 
-        update_price_list(pl["id"], variant_gid, price, pl["currency"], compare_prices.get(market))
+@app.route("/invalidate-price-lists", methods=["POST"])
+def invalidate_price_lists_route():
+    if not _authorized():
+        return _json_response({"error": "Unauthorized"}, 401)
 
-    print("🎉 SYNC COMPLETE", flush=True)
-    return jsonify({"status": "success"}), 200
+    invalidate_price_lists()
+    logger.info("🧹 Invalidated cached price lists")
+    return _json_response({"status": "invalidated"}, 200)
 
 # ---------- RUN ----------
-if __name__ == "__main__":
+# Production runs under gunicorn (see Procfile); the Werkzeug server is for
+# local development only.
+if __name__ == "__main__" and os.getenv("FLASK_DEV"):
     app.run(host="0.0.0.0", port=10000)
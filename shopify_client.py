@@ -0,0 +1,590 @@
+import gzip
+import logging
+import os
+import time
+import threading
+import orjson
+import requests
+from cachetools import TTLCache
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# ---------- ENV ----------
+SHOP = os.getenv("SHOPIFY_SHOP")
+CLIENT_ID = os.getenv("SHOPIFY_CLIENT_ID")
+CLIENT_SECRET = os.getenv("SHOPIFY_CLIENT_SECRET")
+API_VERSION = os.getenv("SHOPIFY_API_VERSION", "2024-07")
+# (connect, read) seconds per Shopify request attempt.
+HTTP_TIMEOUT = (5, float(os.getenv("SHOPIFY_TIMEOUT", "10")))
+# Gzip GraphQL request bodies above GZIP_MIN_BYTES (opt-in).
+GZIP_REQUESTS = os.getenv("SHOPIFY_GZIP_REQUESTS", "0") == "1"
+GZIP_MIN_BYTES = 1024
+
+# Optional shared cache/queue backend.
+REDIS_URL = os.getenv("REDIS_URL")
+
+if REDIS_URL:
+    from redis import Redis
+
+    # Short timeouts so a hung Redis falls through to the local fallbacks
+    # instead of blocking request and job threads until the TCP timeout.
+    REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "1"))
+    REDIS = Redis.from_url(
+        REDIS_URL,
+        socket_connect_timeout=REDIS_TIMEOUT,
+        socket_timeout=REDIS_TIMEOUT,
+    )
+else:
+    REDIS = None
+
+# ---------- HTTP SESSION ----------
+# One pooled keep-alive session for every Shopify call: no TLS handshake per
+# request, and 429/5xx responses are retried with backoff (honours Retry-After).
+# The pool must cover every thread that can be mid-request at once (job
+# workers doing SKU lookups plus fan-out workers), or urllib3 drops the
+# surplus connections and the next call pays a fresh handshake.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=int(os.getenv("SHOPIFY_POOL_SIZE", "24")),
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "POST", "PUT"),
+        raise_on_status=False,
+    ),
+))
+# Static headers live on the session; the access token is added to it
+# whenever a new one is fetched, so calls never build per-request dicts.
+SESSION.headers["Content-Type"] = "application/json"
+
+# ---------- TOKEN CACHE ----------
+SHOPIFY_TOKEN = None
+TOKEN_TIME = 0
+TOKEN_LOCK = threading.Lock()
+
+def _request_shopify_access_token():
+    # Caller must hold TOKEN_LOCK.
+    global SHOPIFY_TOKEN, TOKEN_TIME
+
+    logger.info("🔐 Requesting Shopify access token...")
+
+    url = f"https://{SHOP}/admin/oauth/access_token"
+
+    payload = {
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "grant_type": "client_credentials"
+    }
+
+    res = SESSION.post(
+        url,
+        data=orjson.dumps(payload),
+        timeout=HTTP_TIMEOUT,
+    )
+    if not res.ok:
+        logger.error("❌ Token request failed: %s %s", res.status_code, res.text)
+
+    data = orjson.loads(res.content)
+    if not data.get("access_token"):
+        raise Exception("❌ Token failed")
+
+    SHOPIFY_TOKEN = data["access_token"]
+    TOKEN_TIME = time.time()
+    SESSION.headers["X-Shopify-Access-Token"] = SHOPIFY_TOKEN
+
+    logger.info("✅ Token received")
+    return SHOPIFY_TOKEN
+
+def get_shopify_access_token():
+    # Makes sure SESSION carries a valid token; a plain global check when warm.
+    if SHOPIFY_TOKEN and time.time() - TOKEN_TIME < 3000:
+        return SHOPIFY_TOKEN
+
+    # Cold start only: the refresh thread normally keeps the token warm.
+    with TOKEN_LOCK:
+        if SHOPIFY_TOKEN and time.time() - TOKEN_TIME < 3000:
+            return SHOPIFY_TOKEN
+        return _request_shopify_access_token()
+
+TOKEN_REFRESH_AGE = 2500
+
+def _token_refresh_loop():
+    while True:
+        time.sleep(max(1, TOKEN_REFRESH_AGE - (time.time() - TOKEN_TIME)))
+        try:
+            with TOKEN_LOCK:
+                # A caller may have fetched one while we slept (cold start).
+                if SHOPIFY_TOKEN and time.time() - TOKEN_TIME < TOKEN_REFRESH_AGE:
+                    continue
+                _request_shopify_access_token()
+        except Exception as e:
+            logger.error("❌ Token refresh failed: %r", e)
+            time.sleep(30)
+
+if SHOP and CLIENT_ID:
+    threading.Thread(target=_token_refresh_loop, daemon=True).start()
+
+# ---------- HELPERS ----------
+def _graphql_url():
+    return f"https://{SHOP}/admin/api/{API_VERSION}/graphql.json"
+
+def _rest_url(path):
+    return f"https://{SHOP}/admin/api/{API_VERSION}/{path}"
+
+def _gid_num(gid):
+    # "gid://shopify/ProductVariant/123" -> "123"
+    return gid.rpartition("/")[2]
+
+def _raise_for_status(resp):
+    # Only materialise the body when there is an error worth logging.
+    if not resp.ok:
+        logger.error("❌ Shopify %s %s → %s: %s", resp.request.method, resp.url, resp.status_code, resp.text)
+    resp.raise_for_status()
+
+# ---------- LAST-SENT CACHE ----------
+# Airtable re-sends unchanged Title/Barcode/Size with every price or qty
+# edit; remember what was last written so identical writes can be skipped.
+LAST_SENT_TTL = 3600
+LAST_SENT_MAX = 5000
+_LAST_SENT = OrderedDict()
+_LAST_SENT_LOCK = threading.Lock()
+
+def _already_sent(key, value):
+    with _LAST_SENT_LOCK:
+        entry = _LAST_SENT.get(key)
+        return bool(entry) and entry[0] == value and time.time() - entry[1] < LAST_SENT_TTL
+
+def _remember_sent(key, value):
+    with _LAST_SENT_LOCK:
+        _LAST_SENT[key] = (value, time.time())
+        _LAST_SENT.move_to_end(key)
+        while len(_LAST_SENT) > LAST_SENT_MAX:
+            _LAST_SENT.popitem(last=False)
+
+# ---------- GRAPHQL ----------
+def shopify_graphql(query, variables=None):
+    body = orjson.dumps({"query": query, "variables": variables})
+    headers = None
+
+    if GZIP_REQUESTS and len(body) > GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=1)
+        headers = {"Content-Encoding": "gzip"}
+
+    get_shopify_access_token()
+    resp = SESSION.post(_graphql_url(), data=body, headers=headers, timeout=HTTP_TIMEOUT)
+    _raise_for_status(resp)
+    return orjson.loads(resp.content)
+
+def _graphql_errors(res):
+    # Shopify answers rejected mutations with HTTP 200: collect the top-level
+    # errors plus the userErrors of every (aliased) mutation payload.
+    errors = [e.get("message") for e in res.get("errors") or []]
+    for payload in (res.get("data") or {}).values():
+        if payload:
+            errors += [e.get("message") for e in payload.get("userErrors") or []]
+    return errors
+
+class ShopifyGraphQLError(RuntimeError):
+    # A GraphQL call that came back HTTP 200 but with errors/userErrors.
+    def __init__(self, what, errors):
+        super().__init__(f"Shopify {what} failed: {errors}")
+        self.errors = errors
+
+def _raise_for_graphql(res, what):
+    errors = _graphql_errors(res)
+    if errors:
+        logger.error("❌ Shopify %s failed: %s", what, errors)
+        raise ShopifyGraphQLError(what, errors)
+
+# ---------- MARKET ----------
+MARKET_NAMES = {
+    "UAE": "United Arab Emirates",
+    "Asia": "Asia Market with 55 rate",
+    "America": "America catlog",
+}
+
+# ---------- PRICE LIST CACHE ----------
+CACHED_PRICE_LISTS = None
+CACHED_MARKET_TO_PL = None
+PRICE_LISTS_TIME = 0
+
+_PRICE_LISTS_Q = """
+query {
+  catalogs(first: 20, type: MARKET) {
+    nodes {
+      title
+      status
+      priceList { id currency }
+    }
+  }
+}
+"""
+
+# Shared across processes through Redis so fresh containers/workers skip the
+# catalogs query on their first webhook.
+PRICE_LISTS_KEY = "shopify:price_lists"
+PRICE_LISTS_TTL = 3600
+
+def _set_price_lists(price_lists, loaded_at=None):
+    global CACHED_PRICE_LISTS, CACHED_MARKET_TO_PL, PRICE_LISTS_TIME
+
+    market_to_pl = {
+        market: price_lists[name]
+        for market, name in MARKET_NAMES.items()
+        if name in price_lists
+    }
+    # An empty result is not cached, so the next webhook asks again.
+    if price_lists:
+        CACHED_MARKET_TO_PL = market_to_pl
+        CACHED_PRICE_LISTS = price_lists
+        PRICE_LISTS_TIME = loaded_at or time.time()
+    return market_to_pl
+
+def invalidate_price_lists():
+    # Clears this process and the shared Redis copy; other processes keep
+    # their in-memory copy until it expires (PRICE_LISTS_TTL).
+    global CACHED_PRICE_LISTS, CACHED_MARKET_TO_PL
+
+    CACHED_PRICE_LISTS = None
+    CACHED_MARKET_TO_PL = None
+    if REDIS is not None:
+        try:
+            REDIS.delete(PRICE_LISTS_KEY)
+        except Exception as e:
+            logger.warning("⚠ Redis price list delete failed: %r", e)
+
+def get_market_price_lists():
+    # Returns {market code: {"id", "currency"}}, flattened once from the
+    # catalog titles in MARKET_NAMES.
+    market_to_pl = CACHED_MARKET_TO_PL
+    if market_to_pl is not None and time.time() - PRICE_LISTS_TIME < PRICE_LISTS_TTL:
+        return market_to_pl
+
+    if REDIS is not None:
+        try:
+            cached, ttl = REDIS.pipeline().get(PRICE_LISTS_KEY).ttl(PRICE_LISTS_KEY).execute()
+        except Exception as e:
+            logger.warning("⚠ Redis price list read failed: %r", e)
+            cached = None
+        if cached:
+            # Age the local copy by the shared one's, so it still expires
+            # within PRICE_LISTS_TTL of the original fetch.
+            loaded_at = time.time() - (PRICE_LISTS_TTL - max(ttl, 0))
+            return _set_price_lists(orjson.loads(cached), loaded_at)
+
+    res = shopify_graphql(_PRICE_LISTS_Q)
+    price_lists = {}
+
+    for c in res.get("data", {}).get("catalogs", {}).get("nodes", []):
+        if c.get("status") == "ACTIVE" and c.get("priceList"):
+            price_lists[c["title"]] = {
+                "id": c["priceList"]["id"],
+                "currency": c["priceList"]["currency"],
+            }
+
+    logger.info("📊 Price lists: %s", price_lists)
+
+    if REDIS is not None and price_lists:
+        try:
+            REDIS.setex(PRICE_LISTS_KEY, PRICE_LISTS_TTL, orjson.dumps(price_lists))
+        except Exception as e:
+            logger.warning("⚠ Redis price list write failed: %r", e)
+
+    return _set_price_lists(price_lists)
+
+# ---------- VARIANT ----------
+_VARIANT_BY_SKU_Q = """
+query ($q: String!) {
+  productVariants(first: 1, query: $q) {
+    nodes { id inventoryItem { legacyResourceId } product { id } }
+  }
+}
+"""
+
+# sku -> ((variant_gid, product_gid, inventory_item_id), loaded at); bounded
+# and expiring. TTLCache is not thread-safe, hence the lock.
+SKU_CACHE_TTL = 3600
+SKU_CACHE = TTLCache(maxsize=10000, ttl=SKU_CACHE_TTL)
+SKU_CACHE_LOCK = threading.Lock()
+
+# With Redis, invalidations are stamped under this prefix so every process
+# drops entries loaded before them, not just the one that was asked.
+SKU_INVALIDATED_KEY = "shopify:sku_invalidated:"
+
+def invalidate_sku(sku):
+    with SKU_CACHE_LOCK:
+        SKU_CACHE.pop(sku, None)
+
+    if REDIS is not None:
+        try:
+            REDIS.setex(SKU_INVALIDATED_KEY + sku, SKU_CACHE_TTL, time.time())
+        except Exception as e:
+            logger.warning("⚠ Redis SKU invalidation failed: %r", e)
+
+def _invalidated_since(sku, loaded_at):
+    if REDIS is None:
+        return False
+
+    try:
+        stamp = REDIS.get(SKU_INVALIDATED_KEY + sku)
+    except Exception as e:
+        logger.warning("⚠ Redis SKU invalidation read failed: %r", e)
+        return False
+    return stamp is not None and float(stamp) >= loaded_at
+
+def get_variant_product_and_inventory_by_sku(sku):
+    with SKU_CACHE_LOCK:
+        cached = SKU_CACHE.get(sku)
+    if cached and not _invalidated_since(sku, cached[1]):
+        return cached[0]
+
+    # Stamped before the query so an invalidation racing it still wins.
+    loaded_at = time.time()
+    res = shopify_graphql(_VARIANT_BY_SKU_Q, {"q": f"sku:{sku}"})
+    nodes = res.get("data", {}).get("productVariants", {}).get("nodes", [])
+
+    if not nodes:
+        return None, None, None
+
+    variant_gid = nodes[0]["id"]
+    product_gid = nodes[0]["product"]["id"]
+    # Stored as int so inventory writes can send it without converting.
+    inventory_item_id = int(nodes[0]["inventoryItem"]["legacyResourceId"])
+
+    entry = (variant_gid, product_gid, inventory_item_id)
+    with SKU_CACHE_LOCK:
+        SKU_CACHE[sku] = (entry, loaded_at)
+    return entry
+
+# ---------- PRICE ----------
+_PRICE_ADD_M = """
+mutation ($pl: ID!, $prices: [PriceListPriceInput!]!) {
+  priceListFixedPricesAdd(priceListId: $pl, prices: $prices) {
+    userErrors { message }
+  }
+}
+"""
+
+@lru_cache(maxsize=None)
+def _price_add_mutation(n, with_variant=False):
+    # Aliased priceListFixedPricesAdd document for n price lists, optionally
+    # led by the productVariantUpdate for the default price; built once per shape.
+    var_defs = [f"$pl{i}: ID!, $p{i}: [PriceListPriceInput!]!" for i in range(n)]
+    fields = [
+        f"pl{i}: priceListFixedPricesAdd(priceListId: $pl{i}, prices: $p{i}) "
+        "{ userErrors { message } }"
+        for i in range(n)
+    ]
+
+    if with_variant:
+        var_defs.insert(0, "$input: ProductVariantInput!")
+        fields.insert(0, "variant: productVariantUpdate(input: $input) { userErrors { message } }")
+
+    return f"mutation ({', '.join(var_defs)}) {{\n  " + "\n  ".join(fields) + "\n}"
+
+def _price_input(variant_gid, price, currency, compare_price=None):
+    price_input = {
+        "variantId": variant_gid,
+        "price": {"amount": str(price), "currencyCode": currency},
+    }
+
+    if compare_price is not None:
+        price_input["compareAtPrice"] = {
+            "amount": str(compare_price),
+            "currencyCode": currency,
+        }
+
+    return price_input
+
+def update_price_list(price_list_id, variant_gid, price, currency, compare_price=None):
+    res = shopify_graphql(_PRICE_ADD_M, {
+        "pl": price_list_id,
+        "prices": [_price_input(variant_gid, price, currency, compare_price)],
+    })
+    _raise_for_graphql(res, "price list update")
+
+# Top-level error codes that are not about the document, so the per-mutation
+# fallback would not help.
+_NO_FALLBACK_CODES = frozenset({"THROTTLED", "ACCESS_DENIED", "SHOP_INACTIVE", "INTERNAL_SERVER_ERROR"})
+
+def update_price_lists_bulk(updates, variant_input=None):
+    # updates: [(price_list_id, variant_gid, price, currency, compare_price), ...]
+    # variant_input: optional productVariantUpdate input (default price,
+    # barcode) sent in the same request. Everything goes out as aliased
+    # mutations in a single GraphQL request.
+    if not updates and not variant_input:
+        return
+
+    # One alias per price list carrying every price for it.
+    prices_by_pl = defaultdict(list)
+    for price_list_id, variant_gid, price, currency, compare_price in updates:
+        prices_by_pl[price_list_id].append(_price_input(variant_gid, price, currency, compare_price))
+
+    variables = {}
+    for i, (price_list_id, prices) in enumerate(prices_by_pl.items()):
+        variables[f"pl{i}"] = price_list_id
+        variables[f"p{i}"] = prices
+
+    if variant_input:
+        variables["input"] = variant_input
+
+    logger.debug("💲 Updating variant %s and price lists: %s", variant_input, updates)
+    res = shopify_graphql(_price_add_mutation(len(prices_by_pl), bool(variant_input)), variables)
+
+    if not res.get("errors"):
+        # Only what Shopify accepted goes into the last-sent cache.
+        if variant_input and not ((res.get("data") or {}).get("variant") or {}).get("userErrors"):
+            _remember_variant(variant_input)
+        _raise_for_graphql(res, "price update")
+        return
+
+    codes = {(e.get("extensions") or {}).get("code") for e in res["errors"]}
+    if len(updates) + bool(variant_input) == 1 or codes & _NO_FALLBACK_CODES:
+        # Nothing to split up, or the API refused the call itself: splitting it
+        # would only send more requests into the same failure.
+        _raise_for_graphql(res, "price update")
+
+    # The aliased document was rejected as a whole; the mutations are
+    # independent, so send them as separate requests in parallel instead.
+    logger.warning("⚠ Batched price update rejected, falling back: %s", res["errors"])
+    calls = [partial(update_price_list, *args) for args in updates]
+    if variant_input:
+        calls.append(partial(_update_variant, variant_input))
+
+    # Every call raises on its own errors; ex.map re-raises the first one.
+    with ThreadPoolExecutor(max_workers=len(calls)) as ex:
+        list(ex.map(lambda call: call(), calls))
+
+# ---------- INVENTORY ----------
+PRIMARY_LOCATION_ID = None
+PRIMARY_LOCATION_TIME = 0
+
+def get_primary_location_id():
+    global PRIMARY_LOCATION_ID, PRIMARY_LOCATION_TIME
+
+    if PRIMARY_LOCATION_ID and time.time() - PRIMARY_LOCATION_TIME < 3000:
+        return PRIMARY_LOCATION_ID
+
+    get_shopify_access_token()
+    r = SESSION.get(_rest_url("locations.json"), timeout=HTTP_TIMEOUT)
+    _raise_for_status(r)
+
+    PRIMARY_LOCATION_ID = int(orjson.loads(r.content)["locations"][0]["id"])
+    PRIMARY_LOCATION_TIME = time.time()
+
+    logger.debug("📍 Primary location: %s", PRIMARY_LOCATION_ID)
+    return PRIMARY_LOCATION_ID
+
+def set_inventory_absolute(inventory_item_id, location_id, quantity):
+    # All three are expected as ints already (see the SKU lookup, the location
+    # cache and sync_inventory).
+    if quantity is None:
+        return None
+
+    logger.debug("📦 Updating inventory: %s", quantity)
+    get_shopify_access_token()
+    r = SESSION.post(
+        _rest_url("inventory_levels/set.json"),
+        data=orjson.dumps({
+            "inventory_item_id": inventory_item_id,
+            "location_id": location_id,
+            "available": quantity,
+        }),
+        timeout=HTTP_TIMEOUT,
+    )
+    _raise_for_status(r)
+
+# ---------- VARIANT / TITLE ----------
+_VARIANT_UPDATE_M = """
+mutation ($input: ProductVariantInput!) {
+  productVariantUpdate(input: $input) {
+    productVariant { id }
+    userErrors { message }
+  }
+}
+"""
+
+def variant_update_input(variant_gid, *, barcode=None, price=None, compare_at_price=None):
+    # productVariantUpdate input with only the fields that need writing, or
+    # None when there is nothing to send. ProductVariantInput has no title;
+    # variant titles follow the option values.
+    variant_input = {"id": variant_gid}
+
+    if barcode and not _already_sent(("variant_barcode", variant_gid), barcode):
+        variant_input["barcode"] = barcode
+    if price is not None:
+        variant_input["price"] = str(price)
+    if compare_at_price is not None:
+        variant_input["compareAtPrice"] = str(compare_at_price)
+
+    if len(variant_input) == 1:
+        return None
+
+    return variant_input
+
+def _remember_variant(variant_input):
+    if "barcode" in variant_input:
+        _remember_sent(("variant_barcode", variant_input["id"]), variant_input["barcode"])
+
+def _update_variant(variant_input):
+    logger.debug("✏ Updating variant: %s", variant_input)
+    res = shopify_graphql(_VARIANT_UPDATE_M, {"input": variant_input})
+    _raise_for_graphql(res, "variant update")
+    _remember_variant(variant_input)
+
+def update_product_title(product_gid, title):
+    if not title:
+        return None
+
+    pid = _gid_num(product_gid)
+    if _already_sent(("product_title", pid), title):
+        return None
+
+    url = _rest_url(f"products/{pid}.json")
+
+    payload = {"product": {"id": int(pid), "title": title}}
+
+    logger.debug("✏ Updating product title: %s", payload)
+    get_shopify_access_token()
+    r = SESSION.put(url, data=orjson.dumps(payload), timeout=HTTP_TIMEOUT)
+    _raise_for_status(r)
+    _remember_sent(("product_title", pid), title)
+
+# ---------- METAFIELD ----------
+_METAFIELDS_SET_M = """
+mutation metafieldsSet($metafields: [MetafieldsSetInput!]!) {
+  metafieldsSet(metafields: $metafields) {
+    userErrors { message }
+  }
+}
+"""
+
+def set_metafield(owner_id_gid, namespace, key, mtype, value):
+    if value is None or not str(value).strip():
+        return None
+
+    sent_key = ("metafield", owner_id_gid, namespace, key)
+    if _already_sent(sent_key, str(value)):
+        return None
+
+    variables = {
+        "metafields": [{
+            "ownerId": owner_id_gid,
+            "namespace": namespace,
+            "key": key,
+            "type": mtype,
+            "value": str(value)
+        }]
+    }
+
+    logger.debug("🧩 Setting metafield: %s.%s = %s", namespace, key, value)
+    res = shopify_graphql(_METAFIELDS_SET_M, variables)
+    _raise_for_graphql(res, "metafield update")
+    _remember_sent(sent_key, str(value))